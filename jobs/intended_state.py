@@ -1,41 +1,382 @@
+import io
 import json
+from functools import lru_cache
+from types import MappingProxyType
 
+from django import VERSION as DJANGO_VERSION
 from django.apps import apps
-from django.core.exceptions import FieldError, ObjectDoesNotExist, ValidationError
+from django.core.exceptions import (
+    FieldDoesNotExist,
+    FieldError,
+    MultipleObjectsReturned,
+    ObjectDoesNotExist,
+    ValidationError,
+)
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import ManyToManyField, Model, Q, UniqueConstraint
+from django.db.models.constants import LOOKUP_SEP
 
 from nautobot.extras.jobs import Job, TextVar
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# ijson's pure Python backends are far slower than orjson/json, so only stream with its C backend
+if ijson is not None and ijson.backend != "yajl2_c":
+    ijson = None
+
 name = "POC Jobs"
 
+# bulk_create(update_conflicts=True) is only available on Django 4.1+ and on databases that support ON CONFLICT with
+# unique fields (i.e. not MySQL), anything else (i.e. Nautobot 1.x on Django 3.2) splits each batch into a
+# bulk_create() of the new objects and a bulk_update() of the changed ones instead, see _supports_bulk_upsert
+BULK_UPSERT = DJANGO_VERSION >= (4, 1)
 
-def replace_ref(ref):
-    """Recursively replace references."""
-    if isinstance(ref, dict):
-        for key, value in ref.items():
-            ref[key] = replace_ref(value)
-        return ref
+# Payloads of at least this many characters are streamed with ijson's C backend, when installed, instead of parsed at
+# once
+STREAM_PAYLOAD_SIZE = 10 * 1024 * 1024
 
-    if isinstance(ref, (list, set, tuple)):
-        return [replace_ref(r) for r in ref]
+# Shared read-only stand-in for objects without `defaults`, so that no throw-away dict is built for each of them
+_NO_DEFAULTS = MappingProxyType({})
 
-    if not isinstance(ref, (str, bytes)):
-        return ref
+# The app registry doesn't change while Nautobot is running, so model lookups can be cached for good
+_get_model = lru_cache(maxsize=None)(apps.get_model)
+
+
+def replace_ref(ref, cache=None):
+    """Recursively replace references.
 
+    When a `cache` dict is given, each distinct reference is only looked up once and reused from the cache after.
+    """
+    return _HANDLERS.get(type(ref), _leaf)(ref, cache)
+
+
+def lookup_ref(ref, cache=None):
+    """Look up the object for a single `#ref` string, returning any other string unchanged."""
     if not ref.startswith("#ref"):
         return ref
 
-    ref_split = ref.split(":")
-    # pop off #ref
-    ref_split.pop(0)
-    # Grab the app.model
-    app_name = ref_split.pop(0)
-    object_class = apps.get_model(app_name)
-    # Get every other item in the list for fields
-    fields = [f for f in ref_split[::2]]
-    # and for values start at index 1
-    values = [v for v in ref_split[1::2]]
-    obj_lookup = {fields[i]: values[i] for i in range(len(fields))}
-    return object_class.objects.get(**obj_lookup)
+    _, app_name, *rest = ref.split(":")
+    # After #ref and the app.model, the items alternate between field and value
+    it = iter(rest)
+    obj_lookup = dict(zip(it, it))
+    object_class = _get_model(app_name)
+    if cache is None:
+        return object_class.objects.get(**obj_lookup)
+    cache_key = _ref_cache_key(object_class, obj_lookup)
+    if cache_key not in cache:
+        try:
+            cache[cache_key] = object_class.objects.get(**obj_lookup)
+        except object_class.DoesNotExist:
+            # Remembered as missing until more objects of the model are written, see IntendedState._forget_missing_refs
+            cache[cache_key] = None
+    if cache[cache_key] is None:
+        raise object_class.DoesNotExist(f"{object_class._meta.object_name} matching query does not exist.")
+    return cache[cache_key]
+
+
+def _walk_dict(ref, cache):
+    for key, value in ref.items():
+        ref[key] = replace_ref(value, cache)
+    return ref
+
+
+def _walk_list(ref, cache):
+    for i, value in enumerate(ref):
+        ref[i] = replace_ref(value, cache)
+    return ref
+
+
+def _walk_seq(ref, cache):
+    return [replace_ref(value, cache) for value in ref]
+
+
+def _leaf(ref, cache):
+    return ref
+
+
+# Parsed JSON only contains these exact types, so dispatching on type() avoids an isinstance() chain per node
+_HANDLERS = {dict: _walk_dict, list: _walk_list, tuple: _walk_seq, set: _walk_seq, str: lookup_ref}
+
+
+def _ref_cache_key(object_class, obj_lookup):
+    return (object_class._meta.label_lower, tuple(sorted(obj_lookup.items())))
+
+
+def _collect_refs(ref, acc):
+    """Recursively collect every reference as `(object_class, fields, values)` without resolving it."""
+    if isinstance(ref, dict):
+        for value in ref.values():
+            _collect_refs(value, acc)
+    elif isinstance(ref, (list, set, tuple)):
+        for r in ref:
+            _collect_refs(r, acc)
+    elif isinstance(ref, str) and ref.startswith("#ref"):
+        _, app_name, *rest = ref.split(":")
+        acc.append((_get_model(app_name), tuple(rest[::2]), tuple(rest[1::2])))
+
+
+@lru_cache(maxsize=None)
+def _unique_field_sets(object_class):
+    """Return every set of field names that uniquely identifies an instance of `object_class`."""
+    opts = object_class._meta
+    field_sets = [frozenset([field.name]) for field in opts.concrete_fields if field.unique]
+    field_sets += [frozenset(fields) for fields in opts.unique_together]
+    field_sets += [
+        frozenset(constraint.fields)
+        for constraint in opts.constraints
+        if isinstance(constraint, UniqueConstraint) and constraint.fields and constraint.condition is None
+    ]
+    return frozenset(field_sets)
+
+
+def _lookup_key(fields, values):
+    """Normalize lookup `values` for `fields` into a hashable key that compares equal to the database values."""
+    return tuple(
+        field.to_python(value.pk if isinstance(value, Model) else value) for field, value in zip(fields, values)
+    )
+
+
+@lru_cache(maxsize=None)
+def _concrete_fields(object_class, field_names):
+    """Return the fields for the `field_names` tuple, or None unless each is a concrete, non many-to-many field.
+
+    Cached per model and field names, as the same shapes are checked for every batch and every object.
+    """
+    try:
+        fields = tuple(object_class._meta.get_field(field_name) for field_name in field_names)
+    except FieldDoesNotExist:
+        return None
+    if not all(field.concrete and not field.many_to_many for field in fields):
+        return None
+    return fields
+
+
+@lru_cache(maxsize=None)
+def _resolve_lookups(object_class, field_names):
+    """Resolve each of the `field_names` tuple into `(relations, field)`.
+
+    Names may follow forward relations with `__` (i.e. `site__region__name`), in which case `relations` holds the
+    relation names in order. Returns None unless every name ends in a concrete, non many-to-many field.
+    """
+    resolved = []
+    for field_name in field_names:
+        *relations, name = field_name.split(LOOKUP_SEP)
+        related_class = object_class
+        for relation in relations:
+            try:
+                field = related_class._meta.get_field(relation)
+            except FieldDoesNotExist:
+                return None
+            if not field.concrete or not (field.many_to_one or field.one_to_one):
+                return None
+            related_class = field.related_model
+        fields = _concrete_fields(related_class, (name,))
+        if fields is None:
+            return None
+        resolved.append((tuple(relations), fields[0]))
+    return tuple(resolved)
+
+
+@lru_cache(maxsize=None)
+def _auto_now_fields(object_class):
+    """Return the `auto_now` field names of `object_class`, which `save(update_fields=...)` skips unless named."""
+    return tuple(field.name for field in object_class._meta.concrete_fields if getattr(field, "auto_now", False))
+
+
+def _lookup_value(obj, relations, field):
+    """Return the value of `field` on `obj`, after following `relations`."""
+    for relation in relations:
+        obj = getattr(obj, relation)
+        if obj is None:
+            return None
+    return getattr(obj, field.attname)
+
+
+def _fetch_by_lookup(object_class, field_names, lookups):
+    """Fetch every instance matching one of `lookups` in a single query, indexed by `_lookup_key`.
+
+    Relations traversed by the lookups are joined with `select_related()` so that indexing doesn't query them one
+    instance at a time. Keys matched by more than one instance are left out so that they are never mistaken for a
+    unique match.
+    """
+    resolved = _resolve_lookups(object_class, tuple(field_names))
+    fields = [field for _, field in resolved]
+    if len(field_names) == 1:
+        query = Q(**{f"{field_names[0]}__in": [lookup[0] for lookup in lookups]})
+    else:
+        query = Q()
+        for lookup in lookups:
+            query |= Q(**dict(zip(field_names, lookup)))
+    queryset = object_class.objects.filter(query)
+    related = {LOOKUP_SEP.join(relations) for relations, _ in resolved if relations}
+    if related:
+        queryset = queryset.select_related(*related)
+    found = {}
+    for obj in queryset:
+        key = _lookup_key(fields, [_lookup_value(obj, relations, field) for relations, field in resolved])
+        found[key] = None if key in found else obj
+    return {key: obj for key, obj in found.items() if obj is not None}
+
+
+def _dependencies(intended_state):
+    """Map each model name in `intended_state` to the labels of the models its objects reference."""
+    dependencies = {}
+    for object_name, objects in intended_state.items():
+        refs = []
+        _collect_refs(objects, refs)
+        dependencies[object_name] = {object_class._meta.label_lower for object_class, _, _ in refs}
+    return dependencies
+
+
+def _stream_dependencies(payload):
+    """Build the same mapping as `_dependencies` from the raw `payload` bytes without loading it."""
+    dependencies = {}
+    referenced = set()
+    depth = 0
+    for _, event, value in ijson.parse(io.BytesIO(payload)):
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+        elif event == "map_key" and depth == 1:
+            referenced = dependencies.setdefault(value, set())
+        elif event == "string" and value.startswith("#ref"):
+            referenced.add(_get_model(value.split(":")[1])._meta.label_lower)
+    return dependencies
+
+
+def _is_unchanged(obj, defaults):
+    """Return True when every field in `defaults` already has the given value on `obj`."""
+    fields = _concrete_fields(type(obj), tuple(defaults))
+    if fields is None:
+        return False
+    try:
+        return _lookup_key(fields, defaults.values()) == tuple(getattr(obj, field.attname) for field in fields)
+    except ValidationError:
+        return False
+
+
+def _order_by_dependencies(dependencies):
+    """Order the model names in `dependencies` so that each model comes after the models it references.
+
+    Payload order is kept wherever the references allow it, including for models that reference each other.
+    """
+    names = {_get_model(object_name)._meta.label_lower: object_name for object_name in dependencies}
+    dependencies = {
+        object_name: {names.get(label) for label in labels} - {None, object_name}
+        for object_name, labels in dependencies.items()
+    }
+    ordered = []
+    remaining = list(dependencies)
+    while remaining:
+        done = set(ordered)
+        object_name = next((name for name in remaining if dependencies[name] <= done), remaining[0])
+        ordered.append(object_name)
+        remaining.remove(object_name)
+    return ordered
+
+
+def _iter_intended_state(json_payload):
+    """Yield `(object_class, objects)` for every model in `json_payload`, in `_order_by_dependencies` order.
+
+    Large payloads are read twice instead: once for the dependencies and once to materialise one model's objects at
+    a time. Models that arrive before the models they reference are buffered until those have been processed.
+    """
+    if ijson is None or len(json_payload) < STREAM_PAYLOAD_SIZE:
+        intended_state = _loads(json_payload)
+        for object_name in _order_by_dependencies(_dependencies(intended_state)):
+            yield _get_model(object_name), intended_state.pop(object_name)
+        return
+
+    payload = json_payload.encode()
+    ordered = _order_by_dependencies(_stream_dependencies(payload))
+    pending = {}
+    for object_name, objects in ijson.kvitems(io.BytesIO(payload), "", use_float=True):
+        pending[object_name] = objects
+        while ordered and ordered[0] in pending:
+            object_name = ordered.pop(0)
+            yield _get_model(object_name), pending.pop(object_name)
+
+
+def _shape(object_data):
+    """Return the sorted lookup and `defaults` field names of `object_data`."""
+    lookup_fields = sorted(key for key in object_data if key != "defaults")
+    return tuple(lookup_fields), tuple(sorted(object_data.get("defaults") or _NO_DEFAULTS))
+
+
+def _supports_bulk_upsert(object_class):
+    """Return True when `object_class` can be written with bulk_create(update_conflicts=True) on its database."""
+    if not BULK_UPSERT:
+        return False
+    return connections[router.db_for_write(object_class)].features.supports_update_conflicts_with_target
+
+
+def _bulk_create_and_update(object_class, changed, existing, update_fields):
+    """Write the `(key, lookup, instance, defaults)` tuples in `changed` without `update_conflicts`.
+
+    New objects are inserted with one bulk_create() and the `existing` objects they match are updated with one
+    bulk_update(), which works on any Django version Nautobot supports.
+    """
+    created = [instance for key, _, instance, _ in changed if key not in existing]
+    updated = []
+    for key, _, _, object_defaults in changed:
+        if key in existing:
+            obj = existing[key]
+            for field_name, value in object_defaults.items():
+                setattr(obj, field_name, value)
+            updated.append(obj)
+    if created:
+        object_class.objects.bulk_create(created)
+    if updated and update_fields:
+        object_class.objects.bulk_update(updated, update_fields)
+
+
+def _lookup_identity(object_data):
+    """Return the lookup items of `object_data` as a hashable tuple, or None when its values can't be hashed."""
+    identity = tuple(sorted((key, value) for key, value in object_data.items() if key != "defaults"))
+    try:
+        hash(identity)
+    except TypeError:
+        return None
+    return identity
+
+
+def _group_by_shape(records):
+    """Group the indexes of `records` by `_shape`, keeping their order.
+
+    Records whose lookup also appears with another shape are grouped under None instead, so that they can be written
+    one at a time in payload order and the last one wins, as it would with every record written one at a time.
+    """
+    shapes = [_shape(object_data) for object_data in records]
+    identities = [_lookup_identity(object_data) for object_data in records]
+    shapes_by_identity = {}
+    for identity, shape in zip(identities, shapes):
+        if identity is not None:
+            shapes_by_identity.setdefault(identity, set()).add(shape)
+    groups = {}
+    for i, (identity, shape) in enumerate(zip(identities, shapes)):
+        if identity is not None and len(shapes_by_identity[identity]) > 1:
+            shape = None
+        groups.setdefault(shape, []).append(i)
+    return groups
+
+
+def _group_by_class(pairs):
+    """Group `(object_class, object_data)` pairs into a dict of lists, keeping their order."""
+    groups = {}
+    for object_class, object_data in pairs:
+        groups.setdefault(object_class, []).append(object_data)
+    return groups
 
 
 class IntendedState(Job):
@@ -47,23 +388,356 @@ class IntendedState(Job):
         description = "Create or update objects in Nautobot by passing in an intended state JSON payload."
 
     def run(self, data, commit):
-        json_payload = data["json_payload"]
-        intended_state = json.loads(json_payload)
-        for object_name, objects in intended_state.items():
-            object_class = apps.get_model(object_name)
-            for object_data in objects:
-                for key, value in object_data.items():
+        self._run_intended_state(data["json_payload"])
+
+    def _run_intended_state(self, json_payload):
+        self._m2m_queue = []
+        self._ref_cache = {}
+        deferred = []
+        for object_class, objects in _iter_intended_state(json_payload):
+            objects = self._process(object_class, objects)
+            deferred += [(object_class, object_data) for object_data in objects]
+        # Retry deferred objects for as long as that keeps resolving more of their references
+        while deferred:
+            still_deferred = []
+            for object_class, objects in _group_by_class(deferred).items():
+                still_deferred += [(object_class, object_data) for object_data in self._process(object_class, objects)]
+            if len(still_deferred) == len(deferred):
+                for object_class, objects in _group_by_class(still_deferred).items():
+                    self._process(object_class, objects, defer=False)
+                break
+            deferred = still_deferred
+        self._flush_m2m()
+
+    def _process(self, object_class, objects, defer=True):
+        """Create or update `objects` and queue their many-to-many changes.
+
+        Objects with a reference that can't be resolved yet are returned for a later attempt, unless `defer` is
+        False in which case their errors are logged and they are skipped.
+        """
+        self._prefetch_refs(objects)
+        records = []
+        directives = []
+        deferred = []
+        for object_data in objects:
+            clean_data, extracted, errors, skipped = self._walk(object_data)
+            if errors and defer:
+                deferred.append(object_data)
+                continue
+            if errors:
+                for key, e in errors:
+                    self.log_warning(message=f"Error on key {key}. Error: {e}.")
+                self.log_warning(message=f"Unable to create object {object_data}, skipping it.")
+                continue
+            records.append(clean_data)
+            directives.append((extracted, skipped))
+        results = [None] * len(records)
+        # Objects with the same shape can share one upsert, even when the model's objects don't all match
+        for shape, indexes in _group_by_shape(records).items():
+            bucket = [records[i] for i in indexes]
+            bucket_results = None if shape is None else self._bulk_update_or_create(object_class, bucket)
+            if bucket_results is None:
+                bucket_results = [self._update_or_create(object_class, object_data) for object_data in bucket]
+            for i, obj in zip(indexes, bucket_results):
+                results[i] = obj
+        if records:
+            self._forget_missing_refs(object_class)
+        for obj, (extracted, skipped) in zip(results, directives):
+            if obj is None:
+                continue
+            for directive, fields in skipped.items():
+                for field_name, e in fields:
+                    self.log_warning(obj=obj, message=f"Unable to {directive[1:]} {field_name} on {obj}. Error: {e}.")
+            if extracted.get("#set"):
+                self.obj_set(obj, extracted["#set"])
+            if extracted.get("#add"):
+                self.obj_add(obj, extracted["#add"])
+        return deferred
+
+    def _walk(self, object_data):
+        """Replace the references in `object_data` and pull out its `#set`/`#add` directives in a single pass.
+
+        Directives may be given on the object itself or inside its `defaults`, the former taking precedence.
+        Returns the clean data, the directives, a list of `(key, error)` for references that failed and, for each
+        directive, a list of `(field_name, error)` for the many-to-many fields left out because a reference failed.
+        """
+        clean_data = {}
+        extracted = {}
+        errors = []
+        skipped = {}
+        for key, value in object_data.items():
+            if key == "defaults" and isinstance(value, dict):
+                clean_data[key], defaults_extracted, defaults_errors, defaults_skipped = self._walk(value)
+                for directive, directive_value in defaults_extracted.items():
+                    if directive not in extracted:
+                        extracted[directive] = directive_value
+                        skipped[directive] = defaults_skipped[directive]
+                errors += defaults_errors
+                continue
+            if key in ("#set", "#add"):
+                extracted[key], skipped[key] = self._walk_directive(value)
+                continue
+            try:
+                value = replace_ref(value, self._ref_cache)
+            except (AttributeError, ObjectDoesNotExist, ValidationError) as e:
+                errors.append((key, e))
+            clean_data[key] = value
+        return clean_data, extracted, errors, skipped
+
+    def _walk_directive(self, m2m_dict):
+        """Replace the references in a `#set`/`#add` directive one many-to-many field at a time.
+
+        Fields with a reference that can't be resolved are left out and returned as `(field_name, error)`, so that a
+        missing member doesn't hold back the object or its other fields.
+        """
+        if not isinstance(m2m_dict, dict):
+            return m2m_dict, []
+        resolved = {}
+        skipped = []
+        for field_name, values in m2m_dict.items():
+            try:
+                resolved[field_name] = replace_ref(values, self._ref_cache)
+            except (AttributeError, ObjectDoesNotExist, ValidationError) as e:
+                skipped.append((field_name, e))
+        return resolved, skipped
+
+    def _forget_missing_refs(self, object_class):
+        """Drop the references to `object_class` remembered as missing, as they may exist now that it was written."""
+        label = object_class._meta.label_lower
+        for cache_key in [key for key, obj in self._ref_cache.items() if obj is None and key[0] == label]:
+            del self._ref_cache[cache_key]
+
+    def _prefetch_refs(self, objects):
+        """Resolve every reference in `objects` into the ref cache with one query per model and lookup fields.
+
+        Anything that can't be resolved this way is left out of the cache and looked up by `replace_ref` instead.
+        """
+        groups = {}
+        refs = []
+        _collect_refs(objects, refs)
+        for object_class, fields, values in refs:
+            if _ref_cache_key(object_class, dict(zip(fields, values))) not in self._ref_cache:
+                groups.setdefault((object_class, fields), set()).add(values)
+        for (object_class, fields), lookups in groups.items():
+            resolved = _resolve_lookups(object_class, fields)
+            if resolved is None:
+                continue
+            lookup_fields = [field for _, field in resolved]
+            try:
+                found = _fetch_by_lookup(object_class, fields, lookups)
+                for lookup in lookups:
+                    obj = found.get(_lookup_key(lookup_fields, lookup))
+                    if obj is not None:
+                        self._ref_cache[_ref_cache_key(object_class, dict(zip(fields, lookup)))] = obj
+            except (FieldError, ValueError, ValidationError):
+                continue
+
+    def obj_set(self, obj, set_dict):
+        """Queue replacing the members of each many-to-many field in `set_dict` on `obj`."""
+        self._queue_m2m(obj, set_dict, "set")
+
+    def obj_add(self, obj, add_dict):
+        """Queue adding members to each many-to-many field in `add_dict` on `obj`."""
+        self._queue_m2m(obj, add_dict, "add")
+
+    def _queue_m2m(self, obj, m2m_dict, mode):
+        if not isinstance(m2m_dict, dict):
+            self.log_warning(obj=obj, message=f"Unable to {mode} many-to-many fields. Error: #{mode} must be a dict.")
+            return
+        for field_name, values in m2m_dict.items():
+            if not isinstance(values, list):
+                values = [values]
+            self._m2m_queue.append((obj, field_name, values, mode))
+
+    def _flush_m2m(self):
+        """Write every queued many-to-many change with one query per through table and mode."""
+        groups = {}
+        for obj, field_name, values, mode in self._m2m_queue:
+            groups.setdefault((type(obj), field_name, mode), []).append((obj, values))
+        self._m2m_queue = []
+        # Apply every "#set" before any "#add" so that adding to a field that is also set is not cleared
+        for (object_class, field_name, mode), items in sorted(groups.items(), key=lambda group: group[0][2] != "set"):
+            label = object_class._meta.label
+            try:
+                field = object_class._meta.get_field(field_name)
+                if not (field.many_to_many or field.one_to_many):
+                    self.log_warning(
+                        message=f"Unable to {mode} {field_name} on {label} objects. Error: not a many-to-many field."
+                    )
+                    continue
+                # Changes made through the related manager aren't counted, so they are always reported as updates
+                written = None
+                with transaction.atomic():
+                    if (
+                        isinstance(field, ManyToManyField)
+                        and field.remote_field.through._meta.auto_created
+                        and not field.remote_field.symmetrical
+                    ):
+                        written = self._bulk_write_through(field, items, mode)
+                    else:
+                        for obj, values in items:
+                            if mode == "set":
+                                getattr(obj, field_name).set(values)
+                            else:
+                                getattr(obj, field_name).add(*values)
+            except (AttributeError, DatabaseError, FieldDoesNotExist, TypeError, ValueError, ValidationError) as e:
+                self.log_warning(message=f"Unable to {mode} {field_name} on {label} objects. Error: {e}.")
+                continue
+            if written == 0:
+                self.log_info(message=f"Field {field_name} is already up to date on {len(items)} {label} objects.")
+            else:
+                self.log_success(message=f"Field {field_name} has been updated on {len(items)} {label} objects.")
+
+    @staticmethod
+    def _bulk_write_through(field, items, mode):
+        """Write the rows of an auto-created through table directly, skipping the related manager.
+
+        Only the rows that differ from the current members are deleted or inserted. Returns the number of rows
+        deleted and inserted.
+        """
+        through = field.remote_field.through
+        source = through._meta.get_field(field.m2m_field_name())
+        target = through._meta.get_field(field.m2m_reverse_field_name())
+        desired = {}
+        for obj, values in items:
+            members = {target.to_python(value.pk if isinstance(value, Model) else value) for value in values}
+            if mode == "set":
+                desired[obj.pk] = members
+            else:
+                desired.setdefault(obj.pk, set()).update(members)
+        current = {}
+        rows = through.objects.filter(**{f"{source.attname}__in": list(desired)})
+        for pk, source_pk, target_pk in rows.values_list("pk", source.attname, target.attname):
+            current.setdefault(source_pk, {})[target_pk] = pk
+
+        removed = []
+        added = []
+        for source_pk, members in desired.items():
+            current_members = current.get(source_pk, {})
+            if mode == "set":
+                removed += [pk for target_pk, pk in current_members.items() if target_pk not in members]
+            added += [
+                through(**{source.attname: source_pk, target.attname: target_pk})
+                for target_pk in members
+                if target_pk not in current_members
+            ]
+        if removed:
+            through.objects.filter(pk__in=removed).delete()
+        if added:
+            through.objects.bulk_create(added, ignore_conflicts=True)
+        return len(removed) + len(added)
+
+    def _update_or_create(self, object_class, object_data):
+        """Create or update a single object, one query at a time.
+
+        The object fetched (and locked) to compare against is reused for the create or update, and objects that
+        already match their `defaults` are left alone instead of being saved again. Anything the plain lookup can't
+        handle, including `defaults` that aren't all concrete fields, is left to `update_or_create()`.
+        """
+        lookup = {key: value for key, value in object_data.items() if key != "defaults"}
+        defaults = object_data.get("defaults") or _NO_DEFAULTS
+        reuse = _concrete_fields(object_class, tuple(defaults)) is not None
+        try:
+            with transaction.atomic():
+                obj = None
+                if reuse:
                     try:
-                        object_data[key] = replace_ref(value)
-                    except (AttributeError, ObjectDoesNotExist, ValidationError) as e:
-                        self.log_warning(message=f"Error on key {key}. Error: {e}.")
-                        continue
-                try:
+                        obj = object_class.objects.select_for_update().get(**lookup)
+                    except object_class.DoesNotExist:
+                        reuse = not any(LOOKUP_SEP in key for key in lookup)
+                    except (FieldError, MultipleObjectsReturned, ObjectDoesNotExist, ValueError, ValidationError):
+                        reuse = False
+                if not reuse:
                     obj, created = object_class.objects.update_or_create(**object_data)
-                except (FieldError, ObjectDoesNotExist) as e:
-                    self.log_warning(message=f"Unable to create object. Error: {e}.")
-                    continue
-                self.log_success(obj=obj, message=f"Object {obj} has been {'created' if created else 'updated'}.")
+                elif obj is None:
+                    obj, created = object_class.objects.create(**{**lookup, **defaults}), True
+                elif _is_unchanged(obj, defaults):
+                    self.log_info(obj=obj, message=f"Object {obj} is already up to date.")
+                    return obj
+                else:
+                    for key, value in defaults.items():
+                        setattr(obj, key, value)
+                    obj.save(update_fields=[*defaults, *_auto_now_fields(object_class)])
+                    created = False
+        except (FieldError, ObjectDoesNotExist, TypeError) as e:
+            self.log_warning(message=f"Unable to create object. Error: {e}.")
+            return None
+        self.log_success(obj=obj, message=f"Object {obj} has been {'created' if created else 'updated'}.")
+        return obj
+
+    def _bulk_update_or_create(self, object_class, objects):
+        """Create or update every object of `object_class` with a single upsert.
+
+        Only possible when every object is looked up by the same unique set of fields and sets the same
+        `defaults`. Objects that already match their `defaults` are left out of the upsert. Returns the resulting
+        objects in the same order as `objects` (None for any that could not be created), or None when the objects
+        have to be processed one at a time instead.
+        """
+        if not objects:
+            return None
+        shape = _shape(objects[0])
+        if any(_shape(object_data) != shape for object_data in objects):
+            return None
+        lookup_fields, update_fields = (list(field_names) for field_names in shape)
+        # update_or_create() accepts lookup fields repeated in `defaults`, model instances can't be built from them
+        if set(lookup_fields) & set(update_fields):
+            return None
+        if frozenset(lookup_fields) not in _unique_field_sets(object_class):
+            return None
+        fields = _concrete_fields(object_class, tuple(lookup_fields + update_fields))
+        if fields is None:
+            return None
+
+        lookups = [[object_data[field_name] for field_name in lookup_fields] for object_data in objects]
+        defaults = [object_data.get("defaults") or _NO_DEFAULTS for object_data in objects]
+        try:
+            instances = [
+                object_class(**dict(zip(lookup_fields, lookup)), **object_defaults)
+                for lookup, object_defaults in zip(lookups, defaults)
+            ]
+            keys = [_lookup_key(fields[: len(lookup_fields)], lookup) for lookup in lookups]
+            with transaction.atomic():
+                existing = _fetch_by_lookup(object_class, lookup_fields, lookups)
+                # A lookup repeated in the batch can only be written once, the last one wins as it would one at a time
+                last = {key: i for i, key in enumerate(keys)}
+                changed = [
+                    (key, lookups[i], instances[i], defaults[i])
+                    for key, i in last.items()
+                    if key not in existing or not _is_unchanged(existing[key], defaults[i])
+                ]
+                results = {}
+                if changed and not _supports_bulk_upsert(object_class):
+                    _bulk_create_and_update(object_class, changed, existing, update_fields)
+                elif changed and update_fields:
+                    object_class.objects.bulk_create(
+                        [instance for _, _, instance, _ in changed],
+                        update_conflicts=True,
+                        unique_fields=lookup_fields,
+                        update_fields=update_fields,
+                    )
+                elif changed:
+                    object_class.objects.bulk_create([instance for _, _, instance, _ in changed], ignore_conflicts=True)
+                if changed:
+                    results = _fetch_by_lookup(object_class, lookup_fields, [lookup for _, lookup, _, _ in changed])
+        except (DatabaseError, FieldError, ValueError, ValidationError) as e:
+            self.log_warning(
+                message=f"Unable to bulk create {object_class._meta.label} objects, falling back to one at a time. "
+                f"Error: {e}."
+            )
+            return None
+
+        objs = [results.get(key, existing.get(key)) for key in keys]
+        for key, i in last.items():
+            obj = objs[i]
+            if obj is None:
+                self.log_warning(message=f"Unable to create object. Error: {lookups[i]} not found.")
+            elif key in results:
+                self.log_success(
+                    obj=obj, message=f"Object {obj} has been {'updated' if key in existing else 'created'}."
+                )
+            else:
+                self.log_info(obj=obj, message=f"Object {obj} is already up to date.")
+        return objs
 
 
 jobs = [IntendedState]